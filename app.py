@@ -1,20 +1,34 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import json
 import os
+import bisect
+import contextvars
+import functools
+import itertools
+import math
+import random
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from PIL import Image
-from fpdf import FPDF
-from google import genai
+from PIL import Image, ImageOps
 from collections import defaultdict
 import io
 import pandas as pd
+import numpy as np
 import traceback
+import time
 import pytesseract
+try:
+    # 任意：tesserocrがあればTesseractを常駐させて使う（画像ごとのプロセス起動・モデル読み込みを省く）
+    import tesserocr
+except ImportError:
+    tesserocr = None
 from config_manager import (
     load_stores, save_stores, add_store, remove_store,
     load_items, save_items, add_item_variant, add_new_item, remove_item,
-    auto_learn_store, auto_learn_item
+    auto_learn_store, auto_learn_item, get_config_version
 )
 from email_config_manager import load_email_config, save_email_config, detect_imap_server
 
@@ -25,34 +39,91 @@ st.set_page_config(page_title="配送管理システム", layout="centered")
 COMPANY_NAME = st.secrets.get("COMPANY_NAME", "(株)アイプラス")
 API_KEY = st.secrets.get("GEMINI_API_KEY", "")
 
-client = genai.Client(api_key=API_KEY)
+GEMINI_MODEL = "gemini-2.0-flash"
+
+@st.cache_resource
+def get_client():
+    """Geminiクライアントを作成（再実行のたびに作り直さない）"""
+    # 読み込みに時間がかかるため、初めてAIを呼ぶときにimportする
+    from google import genai
+    return genai.Client(api_key=API_KEY)
 
 def safe_int(v):
     if v is None: return 0
-    if isinstance(v, int): return v
-    s = re.sub(r'\D', '', str(v))
+    # boolはintのサブクラス（True→1、False→0。文字列扱いにすると0になる）
+    if isinstance(v, bool): return int(v)
+    if type(v) is int: return v
+    if type(v) is float: return int(v) if math.isfinite(v) else 0
+    s = str(v)
+    if s.isdecimal(): return int(s)
+    # 数字以外を除去（全角数字も数字として扱う）
+    s = ''.join(filter(str.isdecimal, s))
     return int(s) if s else 0
 
 # 2. 動的設定の読み込み
 def get_known_stores():
-    """店舗名リストを取得（動的）"""
-    return load_stores()
+    """店舗名リストを取得（動的、設定が変わった時だけファイルを読み直す）"""
+    return _load_stores_cached(get_config_version())
 
 def get_item_normalization():
-    """品目名正規化マップを取得（動的）"""
+    """品目名正規化マップを取得（動的、設定が変わった時だけファイルを読み直す）"""
+    return _load_items_cached(get_config_version())
+
+@functools.lru_cache(maxsize=1)
+def _load_stores_cached(config_version):
+    """設定の更新回数ごとに店舗名リストを読み込む（共有するため変更不可のタプルで返す）"""
+    return tuple(load_stores())
+
+@functools.lru_cache(maxsize=1)
+def _load_items_cached(config_version):
+    """設定の更新回数ごとに品目名正規化マップを読み込む（呼び出し側では変更しないこと）"""
     return load_items()
 
 # 3. 品目名正規化関数（動的設定対応）
+@functools.lru_cache(maxsize=1)
+def _item_index(config_version):
+    """品目の検索用インデックスを作成（完全一致用の辞書＋部分一致用の正規表現、設定が変わった時だけ作り直す）"""
+    # 部分一致：全品目の表記ゆれを1つの正規表現にまとめる（設定の登録順に判定）
+    names = []
+    branches = []
+    item_normalization = get_item_normalization()
+    for normalized, variants in item_normalization.items():
+        if not variants:
+            continue
+        alternation = '|'.join(re.escape(variant) for variant in variants)
+        branches.append(f"(?P<g{len(names)}>(?=.*?(?:{alternation})))")
+        names.append(normalized)
+    if not branches:
+        return None, names, {}
+    pattern = re.compile(r'\A(?:' + '|'.join(branches) + ')', re.DOTALL)
+    
+    # 表記ゆれそのものの正規化名（部分一致と同じ結果になるよう正規表現で求めておく）
+    exact = {}
+    for variants in item_normalization.values():
+        for variant in variants:
+            if variant not in exact:
+                exact[variant] = names[int(pattern.match(variant).lastgroup[1:])]
+    return pattern, names, exact
+
+@functools.lru_cache(maxsize=1024)
+def _find_normalized_item(item_name, config_version):
+    """品目名に対応する正規化名を検索（設定の更新回数ごとにメモ化、見つからなければNone）"""
+    pattern, names, exact = _item_index(config_version)
+    normalized = exact.get(item_name)
+    if normalized is not None:
+        return normalized
+    m = pattern.match(item_name) if pattern else None
+    return names[int(m.lastgroup[1:])] if m else None
+
 def normalize_item_name(item_name, auto_learn=True):
     """品目名を正規化する（動的設定対応）"""
     if not item_name:
         return ""
     item_name = str(item_name).strip()
-    item_normalization = get_item_normalization()
     
-    for normalized, variants in item_normalization.items():
-        if item_name in variants or any(variant in item_name for variant in variants):
-            return normalized
+    normalized = _find_normalized_item(item_name, get_config_version())
+    if normalized is not None:
+        return normalized
     
     # 見つからない場合、自動学習
     if auto_learn:
@@ -60,20 +131,61 @@ def normalize_item_name(item_name, auto_learn=True):
     return item_name
 
 # 4. 店舗名検証関数（動的設定対応）
+@functools.lru_cache(maxsize=1)
+def _store_index(config_version):
+    """店舗名の検索用インデックスを作成（完全一致用の集合＋部分一致用の正規表現・連結文字列、設定が変わった時だけ作り直す）"""
+    known_stores = get_known_stores()
+    if not known_stores:
+        return frozenset(), known_stores, None, '', [], {}
+    # 登録済み店舗名が入力に含まれるか：全店舗名を1つの正規表現にまとめる（登録順に判定）
+    branches = '|'.join(f"(?P<g{i}>(?=.*?{re.escape(known_store)}))" for i, known_store in enumerate(known_stores))
+    pattern = re.compile(r'\A(?:' + branches + ')', re.DOTALL)
+    # 入力が登録済み店舗名に含まれるか：区切り文字で連結した1つの文字列を検索する
+    joined = '\0'.join(known_stores)
+    starts = list(itertools.accumulate((len(known_store) + 1 for known_store in known_stores[:-1]), initial=0))
+    # 文字→その文字を含む最初の店舗の番号（近い店舗名の推測用）
+    char_index = {}
+    for i, known_store in enumerate(known_stores):
+        for char in known_store:
+            char_index.setdefault(char, i)
+    return frozenset(known_stores), known_stores, pattern, joined, starts, char_index
+
+@functools.lru_cache(maxsize=1024)
+def _find_known_store(store_name, config_version):
+    """店舗名に対応する登録済み店舗名を検索（設定の更新回数ごとにメモ化、見つからなければNone）"""
+    exact, known_stores, pattern, joined, starts, _ = _store_index(config_version)
+    
+    # 完全一致
+    if store_name in exact:
+        return store_name
+    if not known_stores:
+        return None
+    # 部分一致（どちらの向きでも、登録順で先の店舗を優先）
+    candidates = []
+    m = pattern.match(store_name)
+    if m:
+        candidates.append(int(m.lastgroup[1:]))
+    if '\0' not in store_name:
+        pos = joined.find(store_name)
+        if pos >= 0:
+            candidates.append(bisect.bisect_right(starts, pos) - 1)
+    return known_stores[min(candidates)] if candidates else None
+
+def guess_known_store(store_name):
+    """店舗名と1文字でも共通する登録済み店舗名を推測（登録順で先の店舗を優先、なければNone）"""
+    _, known_stores, _, _, _, char_index = _store_index(get_config_version())
+    matches = [char_index[char] for char in set(store_name) if char in char_index]
+    return known_stores[min(matches)] if matches else None
+
 def validate_store_name(store_name, auto_learn=True):
     """店舗名を検証し、最も近い店舗名を返す（動的設定対応）"""
     if not store_name:
         return None
     store_name = str(store_name).strip()
-    known_stores = get_known_stores()
     
-    # 完全一致
-    if store_name in known_stores:
-        return store_name
-    # 部分一致
-    for known_store in known_stores:
-        if known_store in store_name or store_name in known_store:
-            return known_store
+    known_store = _find_known_store(store_name, get_config_version())
+    if known_store is not None:
+        return known_store
     
     # 見つからない場合、自動学習
     if auto_learn:
@@ -81,14 +193,75 @@ def validate_store_name(store_name, auto_learn=True):
     return None
 
 # 5. OCRでテキスト抽出
+# Tesseractの設定（OEM 1 = LSTMエンジンのみ、PSM 6 = 1つのテキストブロックとして解析）
+OCR_CONFIG = '--oem 1 --psm 6'
+
+# 複数画像を並列にOCRする際、Tesseract内部のOpenMPスレッドがCPUを奪い合わないよう1スレッドに制限
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+# OCR前に縮小する最大辺（文字の高さを保ちつつ処理画素数を抑える）
+OCR_IMAGE_MAX_SIDE = 1600
+
+def preprocess_for_ocr(image):
+    """OCR用にグレースケール化・縮小・二値化（大津の方法）した1ビット画像を返す"""
+    gray = image.convert('L')
+    if max(gray.size) > OCR_IMAGE_MAX_SIDE:
+        gray.thumbnail((OCR_IMAGE_MAX_SIDE, OCR_IMAGE_MAX_SIDE), Image.LANCZOS)
+    
+    # ヒストグラムからクラス間分散が最大になる閾値を求める
+    hist = np.array(gray.histogram(), dtype=np.float64)
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * levels)
+    mu0 = m0 / np.maximum(w0, 1)
+    mu1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    threshold = int(np.argmax(w0 * w1 * (mu0 - mu1) ** 2))
+    # 1ビット画像で渡すとTesseract側の二値化が省かれ、pytesseractの一時ファイルも小さくなる
+    return gray.point([255 if level > threshold else 0 for level in range(256)], '1')
+
+@st.cache_resource
+def get_ocr_api():
+    """tesserocrのAPIを1度だけ初期化して使い回す（利用できない場合はNone）"""
+    if tesserocr is None:
+        return None
+    try:
+        api = tesserocr.PyTessBaseAPI(lang='jpn', oem=tesserocr.OEM.LSTM_ONLY, psm=tesserocr.PSM.SINGLE_BLOCK)
+    except Exception:
+        return None
+    # セッション間で共有するため、同時に1画像ずつ処理する
+    return api, threading.Lock()
+
+@st.cache_resource
+def has_pytesseract_jpn():
+    """Tesseract本体と日本語データ（jpn.traineddata）があるかを1度だけ確認"""
+    try:
+        return 'jpn' in pytesseract.get_languages(config='')
+    except Exception:
+        return False
+
 def extract_text_with_ocr(image):
     """OCRを使用して画像からテキストを抽出"""
+    ocr = get_ocr_api()
+    # OCRが使えない環境では前処理もTesseractの起動もせずに画像解析へ回す
+    if not ocr and not has_pytesseract_jpn():
+        return None
+    image = preprocess_for_ocr(image)
+    if ocr:
+        api, lock = ocr
+        try:
+            with lock:
+                api.SetImage(image)
+                return api.GetUTF8Text().strip()
+        except Exception:
+            # tesserocrで失敗した場合はpytesseractで再試行
+            pass
     try:
         # pytesseractが利用可能かチェック
         if 'pytesseract' not in globals():
             return None
         # pytesseractの設定（日本語対応）
-        text = pytesseract.image_to_string(image, lang='jpn')
+        text = pytesseract.image_to_string(image, lang='jpn', config=OCR_CONFIG)
         return text.strip()
     except NameError:
         # pytesseractがインポートされていない場合
@@ -97,19 +270,20 @@ def extract_text_with_ocr(image):
         # その他のOCRエラー（Tesseractがインストールされていない等）
         return None
 
-# 6. AIテキスト解析（OCR結果を解析、トークン節約）
-def get_order_data_from_text(text, max_retries=3):
-    """OCRで抽出したテキストをAIで解析（画像解析よりトークン消費が少ない）"""
+# 6. 共通プロンプト（テキスト解析・画像解析で共用）
+def build_prompt_rules():
+    """プロンプトの共通部分を取得（設定が変わった時だけ作り直す）"""
+    return _build_prompt_rules(get_config_version())
+
+@functools.lru_cache(maxsize=1)
+def _build_prompt_rules(config_version):
+    """プロンプトの共通部分（店舗名リスト・正規化ルール・計算ルール・出力形式）を生成"""
     known_stores = get_known_stores()
     item_normalization = get_item_normalization()
     
-    # 品目名リストを生成
-    item_list = ", ".join(item_normalization.keys())
     store_list = "、".join(known_stores)
     
-    prompt = f"""以下のテキストは注文メールの内容です。以下の厳密なルールに従ってJSONで返してください。
-
-【店舗名リスト（参考）】
+    return f"""【店舗名リスト（参考）】
 {store_list}
 ※上記リストにない店舗名も読み取ってください。
 
@@ -153,116 +327,119 @@ def get_order_data_from_text(text, max_retries=3):
 【出力JSON形式】
 [{{"store":"店舗名","item":"品目名","spec":"規格","unit":数字,"boxes":数字,"remainder":数字}}]
 
-必ず全ての店舗と品目を漏れなく読み取ってください。
+必ず全ての店舗と品目を漏れなく読み取ってください。"""
 
-テキスト内容:
-{text}
-"""
-    
-    for attempt in range(max_retries):
-        try:
-            response = client.models.generate_content(model="gemini-2.0-flash", contents=prompt)
-            response_text = response.text
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                parts = response_text.split("```")
-                for i, part in enumerate(parts):
-                    if "{" in part and "[" in part:
-                        response_text = part.strip()
-                        break
-            
-            data = json.loads(response_text.strip())
-            return data
-        except json.JSONDecodeError as e:
-            if attempt < max_retries - 1:
-                st.warning(f"JSON解析エラー（試行 {attempt + 1}/{max_retries}）: {e}\n再試行します...")
-                continue
-            else:
-                st.error(f"JSON解析エラー: {e}\n応答テキスト: {response_text[:500]}")
-                return None
-        except Exception as e:
-            if attempt < max_retries - 1:
-                st.warning(f"解析エラー（試行 {attempt + 1}/{max_retries}）: {e}\n再試行します...")
-                continue
-            else:
-                st.error(f"解析エラー: {e}")
-                return None
-    
-    return None
+IMAGE_PROMPT_INSTRUCTION = "画像を解析し、以下の厳密なルールに従ってJSONで返してください。"
 
-# 7. AI画像解析（Gemini 2.0 Flash）- プロンプト強化版（フォールバック用）
-def get_order_data_from_image(image, max_retries=3):
-    """画像を直接AIで解析（OCRが失敗した場合のフォールバック）"""
-    known_stores = get_known_stores()
-    item_normalization = get_item_normalization()
-    
-    item_list = ", ".join(item_normalization.keys())
-    store_list = "、".join(known_stores)
-    
-    prompt = f"""画像を解析し、以下の厳密なルールに従ってJSONで返してください。
+def build_image_prompt():
+    """画像解析用のプロンプトを生成"""
+    return f"""{IMAGE_PROMPT_INSTRUCTION}
 
-【店舗名リスト（参考）】
-{store_list}
-※上記リストにない店舗名も読み取ってください。
+{build_prompt_rules()}"""
 
-【品目名の正規化ルール】
-{json.dumps(item_normalization, ensure_ascii=False, indent=2)}
+# プロンプトのコンテキストキャッシュ（固定ルール部分を1度だけ送信し、以降はキャッシュ名で参照）
+PROMPT_CACHE_TTL_SECONDS = 3600
+# コンテキストキャッシュを作成できる最小トークン数（gemini-2.0-flash。これ未満では作成要求がエラーになる）
+PROMPT_CACHE_MIN_TOKENS = 4096
 
-【重要ルール】
-1. 店舗名の後に「:」または改行がある場合、その後の行は全てその店舗の注文です
-2. 品目名がない行（例：「50×1」）は、直前の品目の続きとして処理してください
-3. 「/」で区切られた複数の注文は、同じ店舗・同じ品目として統合してください
-   - 例：「胡瓜バラ100×7 / 50×1」→ 胡瓜バラ100本×7箱 + 端数50本
-4. 「胡瓜バラ」と「胡瓜3本」は別の規格として扱ってください
-5. unit, boxes, remainderには「数字のみ」を入れてください
+# 期限切れ直前の参照を避けるため、少し早めに作り直す
+@st.cache_resource(ttl=PROMPT_CACHE_TTL_SECONDS - 60, show_spinner=False)
+def _create_prompt_cache(rules):
+    """固定ルール部分のコンテキストキャッシュを作成（全セッションで共有。作成に失敗した場合は例外のままにしてキャッシュしない）"""
+    # 1文字が1トークンを超えることはほぼないため、文字数を上限の目安にする（トークン数を数えるための往復を省く）
+    if len(rules) < PROMPT_CACHE_MIN_TOKENS:
+        print(f"プロンプトキャッシュを作成しません: {len(rules)}文字（最小{PROMPT_CACHE_MIN_TOKENS}トークン）")
+        return None
+    cache = get_client().caches.create(
+        model=GEMINI_MODEL,
+        config={'contents': [rules], 'ttl': f"{PROMPT_CACHE_TTL_SECONDS}s"}
+    )
+    return cache.name
 
-【計算ルール】
-- 胡瓜(3本P): 30本/箱 → unit=30
-- 胡瓜(バラ): 100本/箱（50本以上なら50本箱1、未満はバラ）→ unit=100
-- 春菊: 30袋/箱 → unit=30
-- 青梗菜: 20袋/箱 → unit=20
-- 長ネギ(2本P): 30本/箱 → unit=30
+def get_prompt_cache_name(rules):
+    """固定ルール部分のキャッシュ名を取得（内容変更・期限切れ時は作り直す。作成できない場合はNoneで、ルールは毎回送信）"""
+    try:
+        return _create_prompt_cache(rules)
+    except Exception as e:
+        # 一時的なエラーで以降1時間キャッシュが使えなくならないよう、失敗は記録せず次回また作成を試みる
+        print(f"プロンプトキャッシュ作成エラー: {e}")
+        return None
 
-【最重要：総数（パック数）の表記について】
-- 「×数字」の表記（例：「×180」「×100」「×50」）は「総数（パック数）」を意味します
-- 「×数字」は「箱数」ではなく「総数」です！絶対に間違えないでください！
-- この場合、unit（1箱あたりの入数）とboxes（箱数）を逆算してください
-- 計算式：総数 = unit × boxes + remainder
-- 総数がunitで割り切れる場合：boxes = 総数 ÷ unit, remainder = 0
-- 総数がunitで割り切れない場合：boxes = 総数 ÷ unit（切り捨て）, remainder = 総数 - (unit × boxes)
+# 7. AI呼び出し共通処理（JSON応答の取り出しと再試行）
+# 応答はJSONモード＋スキーマ指定で受け取る（```json の囲みや崩れたJSONが返らない）
+ORDER_RESPONSE_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {
+            'store': {'type': 'STRING'},
+            'item': {'type': 'STRING'},
+            'spec': {'type': 'STRING'},
+            'unit': {'type': 'INTEGER'},
+            'boxes': {'type': 'INTEGER'},
+            'remainder': {'type': 'INTEGER'},
+        },
+        'required': ['store', 'item', 'spec', 'unit', 'boxes', 'remainder'],
+        'property_ordering': ['store', 'item', 'spec', 'unit', 'boxes', 'remainder'],
+    },
+}
+JSON_RESPONSE_CONFIG = {'response_mime_type': 'application/json', 'response_schema': ORDER_RESPONSE_SCHEMA}
 
-【数量計算の例（重要：×数字は総数を意味する）】
-- 「胡瓜3本×180」→ 総数180パック = unit=30の場合、boxes=6, remainder=0 (180÷30=6箱)
-- 「胡瓜3本×100」→ 総数100パック = unit=30の場合、boxes=3, remainder=10 (100÷30=3箱余り10)
-- 「胡瓜3本×60」→ 総数60パック = unit=30の場合、boxes=2, remainder=0 (60÷30=2箱)
-- 「胡瓜3本×30」→ 総数30パック = unit=30の場合、boxes=1, remainder=0 (30÷30=1箱)
-- 「胡瓜3本×20」→ 総数20パック = unit=30の場合、boxes=0, remainder=20 (20<30なので端数のみ)
-- 「春菊×50」→ 総数50パック = unit=30の場合、boxes=1, remainder=20 (50÷30=1箱余り20)
-- 「ネギ2本×80」→ 総数80パック = unit=30の場合、boxes=2, remainder=20 (80÷30=2箱余り20)
-- 「ネギ2本×40」→ 総数40パック = unit=30の場合、boxes=1, remainder=10 (40÷30=1箱余り10)
-- 「胡瓜バラ100×7 / 50×1」→ これは特殊な表記：100本/箱×7箱 + 端数50本 = unit=100, boxes=7, remainder=50
+def parse_order_json(response_text):
+    """AIの応答テキスト（JSONモード）を解析"""
+    return json.loads(response_text)
 
-【出力JSON形式】
-[{{"store":"店舗名","item":"品目名","spec":"規格","unit":数字,"boxes":数字,"remainder":数字}}]
+# AIに送る画像の最大辺（画像トークン数を抑える。OCRには元の画像を使う）
+AI_IMAGE_MAX_SIDE = 1024
 
-必ず全ての店舗と品目を漏れなく読み取ってください。"""
+def resize_for_ai(image):
+    """AIに送る画像を最大辺AI_IMAGE_MAX_SIDEまで縮小（元の画像はプレビュー・OCR用にそのまま残す）"""
+    if max(image.size) <= AI_IMAGE_MAX_SIDE:
+        return image
+    resized = image.copy()
+    resized.thumbnail((AI_IMAGE_MAX_SIDE, AI_IMAGE_MAX_SIDE), Image.LANCZOS)
+    return resized
+
+def image_part_for_ai(image):
+    """AIに送る画像パーツを作成（縮小してJPEGで圧縮。PIL画像のままだとPNGで送られ送信量が大きい）"""
+    from google.genai import types as genai_types
+    image = resize_for_ai(image)
+    if image.mode not in ('L', 'RGB'):
+        image = to_rgb_on_white(image)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return genai_types.Part.from_bytes(data=buffer.getvalue(), mime_type='image/jpeg')
+
+# AI処理モード（低コスト = Flex tier：料金半額、混雑時は応答まで数分かかる）
+AI_TIER_OPTIONS = {"通常": None, "低コスト": "flex"}
+
+# 待ってから再試行するAPIエラー（レート制限・一時的なサーバーエラー）
+RETRYABLE_STATUS_CODES = (429, 500, 503)
+
+def generate_order_json(instruction, parts, max_retries=3):
+    """Geminiを呼び出し、応答からJSONを取り出す（固定ルールはキャッシュ経由、失敗時は再試行）"""
+    from google.genai import errors as genai_errors
+    config = dict(JSON_RESPONSE_CONFIG)
+    service_tier = AI_TIER_OPTIONS.get(st.session_state.get('ai_tier', "通常"))
+    if service_tier:
+        config['service_tier'] = service_tier
+    
+    rules = build_prompt_rules()
+    cache_name = get_prompt_cache_name(rules)
+    if cache_name:
+        config['cached_content'] = cache_name
+        contents = [instruction, *parts]
+    else:
+        contents = [f"{instruction}\n\n{rules}", *parts]
     
     for attempt in range(max_retries):
         try:
-            response = client.models.generate_content(model="gemini-2.0-flash", contents=[prompt, image])
+            response = get_client().models.generate_content(model=GEMINI_MODEL, contents=contents, config=config)
+            # スキーマ指定時はSDKが応答を解析済み（解析できなかった場合のみ自前で解析し、エラーを再試行に回す）
+            if response.parsed is not None:
+                return response.parsed
             response_text = response.text
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                parts = response_text.split("```")
-                for i, part in enumerate(parts):
-                    if "{" in part and "[" in part:
-                        response_text = part.strip()
-                        break
-            
-            data = json.loads(response_text.strip())
-            return data
+            return parse_order_json(response_text)
         except json.JSONDecodeError as e:
             if attempt < max_retries - 1:
                 st.warning(f"JSON解析エラー（試行 {attempt + 1}/{max_retries}）: {e}\n再試行します...")
@@ -272,7 +449,13 @@ def get_order_data_from_image(image, max_retries=3):
                 return None
         except Exception as e:
             if attempt < max_retries - 1:
-                st.warning(f"解析エラー（試行 {attempt + 1}/{max_retries}）: {e}\n再試行します...")
+                if isinstance(e, genai_errors.APIError) and e.code in RETRYABLE_STATUS_CODES:
+                    # 指数バックオフ（1, 2, 4...秒 + ゆらぎ、最大60秒）
+                    wait = min(60, 2 ** attempt + random.random())
+                    st.warning(f"APIが混雑しています（試行 {attempt + 1}/{max_retries}）: {e}\n{wait:.0f}秒後に再試行します...")
+                    time.sleep(wait)
+                else:
+                    st.warning(f"解析エラー（試行 {attempt + 1}/{max_retries}）: {e}\n再試行します...")
                 continue
             else:
                 st.error(f"解析エラー: {e}")
@@ -280,19 +463,52 @@ def get_order_data_from_image(image, max_retries=3):
     
     return None
 
-# 8. ハイブリッド解析（OCR優先、失敗時は画像解析）
-def get_order_data(image, use_ocr=True, max_retries=3):
-    """OCR + AIハイブリッド解析（トークン節約）"""
+# 8. AIテキスト解析（OCR結果を解析、トークン節約）
+def get_order_data_from_text(text, max_retries=3):
+    """OCRで抽出したテキストをAIで解析（画像解析よりトークン消費が少ない）"""
+    instruction = "以下のテキストは注文メールの内容です。以下の厳密なルールに従ってJSONで返してください。"
+    return generate_order_json(instruction, [f"テキスト内容:\n{text}\n"], max_retries)
+
+def get_order_data_from_texts(texts, max_retries=3):
+    """複数画像のOCRテキストを1回のリクエストでまとめてAIで解析"""
+    instruction = f"""以下の{len(texts)}件のテキストは注文メールの内容です（「=== 画像N ===」で区切っています）。以下の厳密なルールに従ってJSONで返してください。
+全てのテキストの注文を1つのJSON配列にまとめて返してください。"""
+    parts = [f"=== 画像{i} ===\nテキスト内容:\n{text}\n" for i, text in enumerate(texts, 1)]
+    return generate_order_json(instruction, parts, max_retries)
+
+# 9. AI画像解析（Gemini 2.0 Flash）- プロンプト強化版（フォールバック用）
+def get_order_data_from_image(image, max_retries=3):
+    """画像を直接AIで解析（OCRが失敗した場合のフォールバック）"""
+    return generate_order_json(IMAGE_PROMPT_INSTRUCTION, [image_part_for_ai(image)], max_retries)
+
+# 10. 複数画像の一括AI解析（1リクエストにまとめて往復回数を削減）
+def get_order_data_from_images(images, max_retries=3):
+    """複数の画像を1回のリクエストでまとめてAIで解析"""
+    instruction = f"""{len(images)}枚の画像を解析し、以下の厳密なルールに従ってJSONで返してください。
+全ての画像の注文を1つのJSON配列にまとめて返してください。"""
+    return generate_order_json(instruction, [image_part_for_ai(image) for image in images], max_retries)
+
+# 11. ハイブリッド解析（OCR優先、失敗時は画像解析）
+# OCR抽出テキストの確認欄に表示する最大文字数
+OCR_PREVIEW_CHARS = 1024
+
+def get_order_data(image, use_ocr=True, max_retries=3, ocr_text=None):
+    """OCR + AIハイブリッド解析（トークン節約、OCR済みのテキストがあれば再OCRしない）"""
     if use_ocr:
         try:
             # まずOCRでテキスト抽出を試みる
-            with st.spinner('OCRでテキスト抽出中...'):
-                ocr_text = extract_text_with_ocr(image)
+            if ocr_text is None:
+                with st.spinner('OCRでテキスト抽出中...'):
+                    ocr_text = extract_text_with_ocr(image)
             
-            if ocr_text and len(ocr_text.strip()) > 10:  # 十分なテキストが抽出できた場合
+            if ocr_text and len(ocr_text) > 10:  # 十分なテキストが抽出できた場合（OCR結果は前後の空白除去済み）
                 st.info(f"✅ OCRでテキスト抽出成功（{len(ocr_text)}文字）")
                 with st.expander("📄 OCR抽出テキストを確認"):
-                    st.text(ocr_text)
+                    # 長いテキストは先頭だけ表示（再実行のたびにブラウザへ全文を送らない）
+                    if len(ocr_text) > OCR_PREVIEW_CHARS:
+                        st.text(ocr_text[:OCR_PREVIEW_CHARS] + f"\n...（残り{len(ocr_text) - OCR_PREVIEW_CHARS}文字は省略）")
+                    else:
+                        st.text(ocr_text)
                 
                 # OCR結果をAIで解析（テキストのみなのでトークン消費が少ない）
                 with st.spinner('AIがテキストを解析中...'):
@@ -314,7 +530,158 @@ def get_order_data(image, use_ocr=True, max_retries=3):
     with st.spinner('AIが画像を直接解析中...'):
         return get_order_data_from_image(image, max_retries)
 
-# 9. ルールベース検証・補完関数（自動学習対応）
+# 12. 複数画像の解析（OCRテキストまたは画像をまとめて1リクエスト、失敗時は1枚ずつ並列）
+# 並列処理の同時実行数の上限（RPM制限対策）
+AI_MAX_WORKERS = 5
+# 1リクエストにまとめる画像の上限（リクエストサイズ制限対策、超える分は分割して解析）
+AI_BATCH_MAX_IMAGES = 8
+
+class AnalysisIncomplete(Exception):
+    """一部の画像だけ解析に失敗（読み取れた分の結果を持ち、キャッシュには残さないための例外）"""
+    def __init__(self, order_data):
+        super().__init__(order_data)
+        self.order_data = order_data
+
+def map_in_threads(func, items):
+    """I/O待ちが主な処理をスレッドで並列実行（ワーカーのst.*表示は呼び出し元の位置に、入力の順に並べて出す）"""
+    ctx = get_script_run_ctx()
+    # 表示先のコンテナはContextVarで管理され、ワーカースレッドには引き継がれない。
+    # 要素ごとの表示枠をスクリプトスレッドで先に並べ、その枠を有効にしたコンテキストの中で各処理を実行する
+    contexts = []
+    for _ in items:
+        with st.container():
+            contexts.append(contextvars.copy_context())
+    with ThreadPoolExecutor(
+        max_workers=min(AI_MAX_WORKERS, len(items)),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        return list(executor.map(lambda context, item: context.run(func, item), contexts, items))
+
+def get_order_data_batch(images, use_ocr=True, max_retries=3):
+    """複数画像をまとめて解析（OCRテキスト→画像の順にまとめて1リクエスト、失敗時は1枚ずつ解析）"""
+    if len(images) == 1:
+        return get_order_data(images[0], use_ocr=use_ocr, max_retries=max_retries)
+    
+    if len(images) > AI_BATCH_MAX_IMAGES:
+        all_order_data = []
+        incomplete = False
+        for start in range(0, len(images), AI_BATCH_MAX_IMAGES):
+            try:
+                order_data = get_order_data_batch(images[start:start + AI_BATCH_MAX_IMAGES], use_ocr, max_retries)
+            except AnalysisIncomplete as e:
+                order_data = e.order_data
+                incomplete = True
+            if order_data:
+                all_order_data.extend(order_data)
+            else:
+                st.warning(f"⚠️ 画像{start + 1}〜{min(start + AI_BATCH_MAX_IMAGES, len(images))}枚目の解析に失敗しました")
+                incomplete = True
+        if incomplete and all_order_data:
+            raise AnalysisIncomplete(all_order_data)
+        return all_order_data or None
+    
+    texts = [None] * len(images)
+    if use_ocr:
+        # OCRは並列に実行し、全画像から十分なテキストが取れたらテキストをまとめて解析（トークン節約）
+        with st.spinner(f'{len(images)}枚の画像からOCRでテキスト抽出中...'):
+            texts = map_in_threads(extract_text_with_ocr, images)
+        if all(text and len(text) > 10 for text in texts):
+            with st.spinner(f'AIが{len(images)}件のテキストをまとめて解析中...'):
+                order_data = get_order_data_from_texts(texts, max_retries)
+            if order_data:
+                return order_data
+    
+    with st.spinner(f'AIが{len(images)}枚の画像をまとめて解析中...'):
+        order_data = get_order_data_from_images(images, max_retries)
+    if order_data:
+        return order_data
+    
+    st.warning("⚠️ まとめて解析に失敗。1枚ずつ解析に切り替えます...")
+    # まとめて解析で抽出済みのOCRテキストを使い回す（同じ画像を再度OCRしない）
+    results = map_in_threads(
+        lambda args: get_order_data(args[0], use_ocr=use_ocr, max_retries=max_retries, ocr_text=args[1]),
+        list(zip(images, texts)))
+    
+    all_order_data = []
+    failed = []
+    for idx, order_data in enumerate(results, 1):
+        if order_data:
+            all_order_data.extend(order_data)
+        else:
+            failed.append(str(idx))
+    # 一部の画像が失敗しても、読み取れた画像の結果は返す（キャッシュはしない）
+    if failed and all_order_data:
+        st.warning(f"⚠️ 画像{', '.join(failed)}枚目の解析に失敗しました。該当画像は再度解析してください")
+        raise AnalysisIncomplete(all_order_data)
+    return all_order_data or None
+
+# 13. バッチモード解析（Gemini Batch API：料金半額、結果は数分〜最大24時間後）
+BATCH_SUCCESS_STATES = ('JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED')
+BATCH_DONE_STATES = BATCH_SUCCESS_STATES + ('JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED')
+
+def submit_batch_job(images):
+    """Gemini Batch APIで画像を1枚ずつのリクエストとしてまとめて投入し、ジョブ名を返す（結果は後から確認）"""
+    prompt = build_image_prompt()
+    inline_requests = []
+    for image in images:
+        inline_requests.append({
+            'contents': [{
+                'role': 'user',
+                'parts': [
+                    {'text': prompt},
+                    image_part_for_ai(image)
+                ]
+            }],
+            'config': JSON_RESPONSE_CONFIG
+        })
+    
+    try:
+        job = get_client().batches.create(
+            model=GEMINI_MODEL,
+            src=inline_requests,
+            config={'display_name': f"orders_{datetime.now().strftime('%Y%m%d%H%M%S')}"}
+        )
+    except Exception as e:
+        st.error(f"バッチ処理エラー: {e}")
+        return None
+    return job.name
+
+def get_batch_job_results(job_name):
+    """バッチジョブの状態を1回だけ確認し、(終了したか, 解析結果) を返す（完了まで待たない）"""
+    try:
+        job = get_client().batches.get(name=job_name)
+    except Exception as e:
+        st.error(f"バッチ処理エラー: {e}")
+        return False, None
+    
+    if job.state.name not in BATCH_DONE_STATES:
+        st.info(f"⏳ バッチ処理中です（状態: {job.state.name}）。しばらくしてから再度確認してください")
+        return False, None
+    if job.state.name not in BATCH_SUCCESS_STATES:
+        st.error(f"バッチ処理が完了しませんでした（状態: {job.state.name}）")
+        return True, None
+    
+    all_order_data = []
+    for idx, inline_response in enumerate(job.dest.inlined_responses):
+        if inline_response.error or not inline_response.response:
+            st.warning(f"⚠️ 画像{idx + 1}の解析に失敗しました: {inline_response.error}")
+            continue
+        try:
+            all_order_data.extend(parse_order_json(inline_response.response.text))
+        except json.JSONDecodeError as e:
+            st.warning(f"⚠️ 画像{idx + 1}のJSON解析エラー: {e}")
+    # 一部の画像が失敗しても、読み取れた画像の結果は返す（ディスクキャッシュを通らないのでそのまま使える）
+    return True, all_order_data or None
+
+def set_batch_job(job_name):
+    """投入中のバッチジョブ名をセッションとURLに保存（ページを再読み込みしても結果を確認できる。Noneで削除）"""
+    st.session_state.batch_job = job_name
+    if job_name:
+        st.query_params['batch_job'] = job_name
+    else:
+        st.query_params.pop('batch_job', None)
+
+# 14. ルールベース検証・補完関数（自動学習対応）
 def validate_and_fix_order_data(order_data, auto_learn=True):
     """AIが読み取ったデータを検証し、必要に応じて修正する（自動学習対応）"""
     if not order_data:
@@ -325,7 +692,9 @@ def validate_and_fix_order_data(order_data, auto_learn=True):
     learned_stores = []
     learned_items = []
     
-    known_stores = get_known_stores()
+    # 同じ店舗名・品目名は1回だけ検証する（行ごとの設定ファイル確認・検索を省く）
+    store_results = {}
+    item_results = {}
     
     for i, entry in enumerate(order_data):
         # 必須フィールドのチェック
@@ -333,7 +702,9 @@ def validate_and_fix_order_data(order_data, auto_learn=True):
         item = entry.get('item', '').strip()
         
         # 店舗名の検証と修正（自動学習）
-        validated_store = validate_store_name(store, auto_learn=auto_learn)
+        if store not in store_results:
+            store_results[store] = validate_store_name(store, auto_learn=auto_learn)
+        validated_store = store_results[store]
         if not validated_store and store:
             if auto_learn:
                 validated_store = auto_learn_store(store)
@@ -342,13 +713,12 @@ def validate_and_fix_order_data(order_data, auto_learn=True):
             else:
                 errors.append(f"行{i+1}: 不明な店舗名「{store}」")
                 # 最も近い店舗名を推測
-                for known_store in known_stores:
-                    if any(char in store for char in known_store):
-                        validated_store = known_store
-                        break
+                validated_store = guess_known_store(store)
         
         # 品目名の正規化（自動学習）
-        normalized_item = normalize_item_name(item, auto_learn=auto_learn)
+        if item not in item_results:
+            item_results[item] = normalize_item_name(item, auto_learn=auto_learn)
+        normalized_item = item_results[item]
         if not normalized_item and item:
             if auto_learn:
                 normalized_item = auto_learn_item(item)
@@ -418,23 +788,92 @@ def validate_and_fix_order_data(order_data, auto_learn=True):
     
     return validated_data
 
-# 7. PDF作成（B5サイズ：一覧表 ＋ 伝票）
+# 15. 解析結果のディスクキャッシュ（同じ画像の再解析ではAIを呼ばない）
+class AnalysisFailed(Exception):
+    """解析失敗（失敗結果をキャッシュに残さないための例外）"""
+
+def open_image_for_analysis(image_bytes):
+    """解析用に画像を開く（JPEGはOCR・AIに必要な大きさまで縮小デコードし、撮影時の向きを補正）"""
+    image = Image.open(io.BytesIO(image_bytes))
+    scale = max(OCR_IMAGE_MAX_SIDE, AI_IMAGE_MAX_SIDE) / max(image.size)
+    if scale < 1:
+        image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    return ImageOps.exif_transpose(image)
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _analyze_images_cached(images_bytes):
+    """画像のバイト列をキーに解析結果をキャッシュ（アプリ再起動後も有効）"""
+    images = [open_image_for_analysis(image_bytes) for image_bytes in images_bytes]
+    order_data = get_order_data_batch(images)
+    if not order_data:
+        raise AnalysisFailed()
+    return order_data
+
+def analyze_images(images_bytes):
+    """画像を解析（同じ画像の組み合わせは前回の結果を即座に返す）"""
+    try:
+        return _analyze_images_cached(tuple(images_bytes))
+    except AnalysisFailed:
+        return None
+    except AnalysisIncomplete as e:
+        # 一部失敗した結果は今回だけ使い、次回は失敗した画像も含めて解析し直す
+        return e.order_data
+
+def to_rgb_on_white(image):
+    """RGBに変換（透過PNGのスクリーンショット等は、透明部分が黒くならないよう白背景に合成する）"""
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+@st.cache_data(show_spinner=False, max_entries=50)
+def make_preview_image(image_bytes):
+    """アップロード画像のプレビュー用縮小JPEGを作成（再実行のたびにデコード・再エンコードしない）"""
+    # JPEGは縮小デコードされ、全解像度を展開しない
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.thumbnail((800, 800))
+        buffer = io.BytesIO()
+        # 再エンコードでEXIFの向き情報が落ちるため、先に向きを補正しておく
+        to_rgb_on_white(ImageOps.exif_transpose(image)).save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+# 16. PDF作成（B5サイズ：一覧表 ＋ 伝票）
 def create_b5_pdf(data):
+    # fpdfは読み込みに時間がかかるため、PDFを作るときにimportする
+    from fpdf import FPDF
+    
     # B5サイズ (182mm x 257mm)
     pdf = FPDF(orientation='P', unit='mm', format=(182, 257))
     
     # フォント登録（ipaexg.ttfが実行ディレクトリに必要）
+    # 使うのは太字スタイルのみなので、TTFの読み込みは1回だけにする
     if os.path.exists('ipaexg.ttf'):
-        pdf.add_font('Gothic', fname='ipaexg.ttf')
         pdf.add_font('Gothic', style='B', fname='ipaexg.ttf')
         font_name = 'Gothic'
     else:
         font_name = 'Arial' # フォントがない場合の予備
     
+    # 店舗→品目の順に並べる（一覧表・伝票とも店舗ごとにまとまる）
+    data = sorted(data, key=lambda e: (e.get('store') or '', e.get('item') or ''))
+    
     # 日付計算
     tomorrow = datetime.now() + timedelta(days=1)
     tomorrow_pdf_str = tomorrow.strftime('%m 月 %d 日')
     tomorrow_list_str = tomorrow.strftime('%m/%d')
+    
+    # 数量は一度だけ整数化し、合計はまとめて計算（一覧表・伝票で共用）
+    n = len(data)
+    units = np.fromiter((safe_int(e.get('unit', 0)) for e in data), dtype=np.int64, count=n)
+    boxes = np.fromiter((safe_int(e.get('boxes', 0)) for e in data), dtype=np.int64, count=n)
+    remainders = np.fromiter((safe_int(e.get('remainder', 0)) for e in data), dtype=np.int64, count=n)
+    rem_boxes = (remainders > 0).astype(np.int64)
+    totals = units * boxes + remainders
+    quantities = list(zip(units.tolist(), boxes.tolist(), remainders.tolist(),
+                          rem_boxes.tolist(), totals.tolist()))
+    # 文字項目も一度だけ取り出す
+    texts = [(e.get('store', ''), e.get('item', ''), e.get('spec', '')) for e in data]
 
     # --- 1ページ目：全体一覧表 ---
     pdf.add_page()
@@ -450,72 +889,96 @@ def create_b5_pdf(data):
     pdf.cell(20, 12, " 端数箱", border=1, fill=True, align='C')
     pdf.cell(30, 12, " TOTALパック数", border=1, fill=True, align='C', ln=True)
     
-    # テーブル内容
+    # テーブル内容（LINE用集計も同じループで作成）
     pdf.set_font(font_name, style='B', size=14)
-    for entry in data:
-        b_val = safe_int(entry.get('boxes', 0))
-        r_val = safe_int(entry.get('remainder', 0))
-        rem_box = 1 if r_val > 0 else 0
+    summary_packs = defaultdict(int)
+    for (store, item, spec), (_, b_val, _, rem_box, total_qty) in zip(texts, quantities):
         total_packs = b_val + rem_box  # フル箱 + 端数箱 = パック数
         
-        pdf.cell(45, 12, f" {entry.get('store','')}", border=1)
-        pdf.cell(45, 12, f" {entry.get('item','')}", border=1)
+        # キーをitemとspecの組み合わせにする（胡瓜の3本Pとバラを別物として扱う）
+        summary_packs[(item, spec.strip())] += total_qty
+        
+        pdf.cell(45, 12, f" {store}", border=1)
+        pdf.cell(45, 12, f" {item}", border=1)
         pdf.cell(20, 12, f" {b_val}", border=1, align='C')
         pdf.cell(20, 12, f" {rem_box}", border=1, align='C')
         pdf.cell(30, 12, f" {total_packs}", border=1, align='C', ln=True)
 
     # --- 2ページ目以降：個別伝票 ---
-    for entry in data:
+    col1, col2, h = 45, 122, 30
+    current_size = None
+    
+    def set_font_size(size):
+        """文字サイズが変わる時だけフォントを切り替える"""
+        nonlocal current_size
+        if size != current_size:
+            pdf.set_font(font_name, style='B', size=size)
+            current_size = size
+    
+    # ページ共通の設定は最初に1回だけ（add_pageの後も引き継がれる）
+    pdf.set_auto_page_break(auto=False)
+    pdf.set_line_width(0.2)
+    
+    for (store, item, spec), (u_val, b_val, r_val, rem_box, total_qty) in zip(texts, quantities):
         pdf.add_page()
-        pdf.set_auto_page_break(auto=False)
-        pdf.set_line_width(0.2)
         
-        pdf.set_font(font_name, style='B', size=26)
+        set_font_size(26)
         pdf.cell(0, 25, f"{COMPANY_NAME} (千葉県産)", align='C', ln=True)
         pdf.ln(2)
-
-        col1, col2, h = 45, 122, 30
-        
-        # 行先
-        pdf.set_font(font_name, style='B', size=18); pdf.cell(col1, h, " 行先", border=1)
-        pdf.set_font(font_name, style='B', size=36); pdf.cell(col2, h, f" {entry.get('store','')}", border=1, ln=True)
-        
-        # 商品名
-        pdf.set_font(font_name, style='B', size=18); pdf.cell(col1, h, " 商品名", border=1)
-        pdf.set_font(font_name, style='B', size=32); pdf.cell(col2, h, f" {entry.get('item','')}", border=1, ln=True)
-        
-        # 出荷日
-        pdf.set_font(font_name, style='B', size=18); pdf.cell(col1, h, " 出荷日", border=1)
-        pdf.set_font(font_name, style='B', size=26); pdf.cell(col2, h, f" {tomorrow_pdf_str}", border=1, ln=True)
-        
-        # 規格
-        pdf.set_font(font_name, style='B', size=18); pdf.cell(col1, h, " 規格", border=1)
-        pdf.set_font(font_name, style='B', size=26); pdf.cell(col2, h, f" {entry.get('spec', '')}", border=1, ln=True)
-        
-        # 入数・箱数
-        u_val = safe_int(entry.get('unit',0))
-        b_val = safe_int(entry.get('boxes',0))
-        r_val = safe_int(entry.get('remainder',0))
-        
-        pdf.set_font(font_name, style='B', size=18); pdf.cell(col1, h, " 入数", border=1)
-        pdf.set_font(font_name, style='B', size=24); pdf.cell(col2/2, h, f" {u_val}", border=1)
-        pdf.cell(col2/2, h, f" {b_val} ケース", border=1, ln=True)
         
-        # 端数
-        pdf.set_font(font_name, style='B', size=18); pdf.cell(col1, h, " 端数", border=1)
-        pdf.set_font(font_name, style='B', size=24); pdf.cell(col2/2, h, f" {r_val if r_val > 0 else ''}", border=1)
-        rem_box = 1 if r_val > 0 else 0
-        pdf.cell(col2/2, h, f" {rem_box} ケース", border=1, ln=True)
+        # 各行: (ラベル, ラベル文字サイズ, 値の文字サイズ, 値のセル)
+        slip_rows = (
+            (" 行先", 18, 36, (f" {store}",)),
+            (" 商品名", 18, 32, (f" {item}",)),
+            (" 出荷日", 18, 26, (f" {tomorrow_pdf_str}",)),
+            (" 規格", 18, 26, (f" {spec}",)),
+            (" 入数", 18, 24, (f" {u_val}", f" {b_val} ケース")),
+            (" 端数", 18, 24, (f" {r_val if r_val > 0 else ''}", f" {rem_box} ケース")),
+            (" TOTAL 数", 20, 42, (f" {total_qty}",)),
+        )
         
-        # TOTAL
-        pdf.set_font(font_name, style='B', size=20); pdf.cell(col1, h, " TOTAL 数", border=1)
-        pdf.set_font(font_name, style='B', size=42)
-        total_qty = (u_val * b_val) + r_val
-        pdf.cell(col2, h, f" {total_qty}", border=1, ln=True)
+        # ラベル列をまとめて描画してから値の列を描画（フォント切り替えを減らす）
+        x0, y0 = pdf.l_margin, pdf.get_y()
+        for i, (label, label_size, _, _) in enumerate(slip_rows):
+            set_font_size(label_size)
+            pdf.set_xy(x0, y0 + i * h)
+            pdf.cell(col1, h, label, border=1)
+        for i, (_, _, value_size, values) in enumerate(slip_rows):
+            set_font_size(value_size)
+            pdf.set_xy(x0 + col1, y0 + i * h)
+            for value in values:
+                pdf.cell(col2 / len(values), h, value, border=1)
+        pdf.set_xy(x0, y0 + len(slip_rows) * h)
+
+    return bytes(pdf.output()), summary_packs
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def create_b5_pdf_cached(data, today):
+    """同じ注文データのPDFは作り直さない（伝票の日付が変わるため、作成日もキーに含める）"""
+    return create_b5_pdf(data)
+
+# LINE用集計の単位（品目名に含まれる語→単位、該当しない品目は「パック」）
+UNIT_LABELS = {'春菊': '袋', '青梗菜': '袋', 'チンゲン菜': '袋'}
 
-    return pdf.output()
+@functools.lru_cache(maxsize=256)
+def get_unit_label(item, spec):
+    """品目名と規格から単位を判定"""
+    # 胡瓜はバラなら本、それ以外（3本P）はパック
+    if "胡瓜" in item or "きゅうり" in item:
+        return "本" if "バラ" in spec or "ばら" in spec else "パック"
+    return next((label for word, label in UNIT_LABELS.items() if word in item), "パック")
 
-# 10. メイン画面レイアウト
+def build_line_summary(summary_packs):
+    """品目・規格ごとの総数からLINE用集計テキストを作成"""
+    lines = [f"【{datetime.now().strftime('%m/%d')} 出荷・作成総数】"]
+    # キーをソートして表示（品目名→規格の順）
+    for (item, spec), total in sorted(summary_packs.items()):
+        # 表示形式: 品目名(規格)：数量単位
+        display_name = f"{item}({spec})" if spec else item
+        lines.append(f"・{display_name}：{total}{get_unit_label(item, spec)}")
+    return "\n".join(lines) + "\n"
+
+# 17. メイン画面レイアウト
 st.title("📦 配送伝票作成システム")
 
 # タブ作成
@@ -532,36 +995,61 @@ if 'email_config' not in st.session_state:
     st.session_state.email_config = load_email_config(st.secrets)
 if 'email_password' not in st.session_state:
     st.session_state.email_password = ""
+if 'email_results' not in st.session_state:
+    st.session_state.email_results = None
+if 'batch_job' not in st.session_state:
+    st.session_state.batch_job = st.query_params.get('batch_job')
 
 # ===== タブ1: 画像解析 =====
 with tab1:
-    uploaded_file = st.file_uploader("注文画像をアップロード", type=['png', 'jpg', 'jpeg'])
+    uploaded_files = st.file_uploader("注文画像をアップロード", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True)
     
-    if uploaded_file:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="アップロード画像", use_container_width=True)
+    if uploaded_files:
+        for uploaded_file in uploaded_files:
+            st.image(make_preview_image(uploaded_file.getvalue()), caption=f"アップロード画像: {uploaded_file.name}", use_container_width=True)
         
         # 新しい画像がアップロードされた場合はセッション状態をリセット
-        if st.session_state.image_uploaded != uploaded_file.name:
+        uploaded_names = [f.name for f in uploaded_files]
+        if st.session_state.image_uploaded != uploaded_names:
             st.session_state.order_data = None
             st.session_state.validated_data = None
-            st.session_state.image_uploaded = uploaded_file.name
+            st.session_state.image_uploaded = uploaded_names
+        
+        st.radio(
+            "処理モード",
+            list(AI_TIER_OPTIONS),
+            horizontal=True,
+            key='ai_tier',
+            help="低コスト: 料金半額（Flex）。混雑時は結果が出るまで数分かかることがあります"
+        )
+        batch_mode = st.checkbox(
+            "バッチモード（料金半額・結果が出るまで数分〜最大24時間かかります）",
+            value=False,
+            help="急がない大量の画像を前日にまとめて処理する場合に使用してください。投入後は「バッチ結果を確認」で結果を取得します"
+        )
         
         col1, col2 = st.columns(2)
         
         with col1:
             if st.button("🔍 AI解析を実行", type="primary", use_container_width=True):
-                with st.spinner('AIが解析中...'):
-                    order_data = get_order_data(image)
-                    if order_data:
-                        # 検証と修正
-                        validated_data = validate_and_fix_order_data(order_data)
-                        st.session_state.order_data = order_data
-                        st.session_state.validated_data = validated_data
-                        st.success(f"✅ {len(validated_data)}件のデータを読み取りました")
+                if batch_mode:
+                    with st.spinner('バッチジョブを投入中...'):
+                        job_name = submit_batch_job([open_image_for_analysis(f.getvalue()) for f in uploaded_files])
+                    if job_name:
+                        set_batch_job(job_name)
                         st.rerun()
-                    else:
-                        st.error("解析に失敗しました。画像を確認してください。")
+                else:
+                    with st.spinner('AIが解析中...'):
+                        order_data = analyze_images([f.getvalue() for f in uploaded_files])
+                        if order_data:
+                            # 検証と修正
+                            validated_data = validate_and_fix_order_data(order_data)
+                            st.session_state.order_data = order_data
+                            st.session_state.validated_data = validated_data
+                            st.success(f"✅ {len(validated_data)}件のデータを読み取りました")
+                            st.rerun()
+                        else:
+                            st.error("解析に失敗しました。画像を確認してください。")
         
         with col2:
             if st.button("🔄 解析結果をリセット", use_container_width=True):
@@ -569,26 +1057,40 @@ with tab1:
                 st.session_state.validated_data = None
                 st.rerun()
         
+        # 投入済みのバッチジョブ（状態はボタンを押したときに1回だけ確認し、完了まで画面を止めない）
+        if st.session_state.batch_job:
+            st.info(f"📨 バッチジョブ投入済み: {st.session_state.batch_job}（結果が出るまで数分〜最大24時間かかります）")
+            if st.button("🔄 バッチ結果を確認", use_container_width=True, key="check_batch_job"):
+                with st.spinner('バッチジョブの状態を確認中...'):
+                    done, order_data = get_batch_job_results(st.session_state.batch_job)
+                if done:
+                    set_batch_job(None)
+                    if order_data:
+                        validated_data = validate_and_fix_order_data(order_data)
+                        st.session_state.order_data = order_data
+                        st.session_state.validated_data = validated_data
+                        st.success(f"✅ {len(validated_data)}件のデータを読み取りました")
+                        st.rerun()
+                    else:
+                        st.error("バッチ処理の結果を読み取れませんでした。画像を確認してください。")
+        
         # 結果確認・編集画面
         if st.session_state.validated_data:
             st.divider()
             st.subheader("📝 解析結果の確認・編集")
             st.write("以下のテーブルでデータを確認・編集できます。編集後は「PDFを生成」ボタンを押してください。")
             
-            # 編集可能なデータフレームの準備
-            df_data = []
-            for entry in st.session_state.validated_data:
-                df_data.append({
-                    '店舗名': entry.get('store', ''),
-                    '品目': entry.get('item', ''),
-                    '規格': entry.get('spec', ''),
-                    '入数(unit)': entry.get('unit', 0),
-                    '箱数(boxes)': entry.get('boxes', 0),
-                    '端数(remainder)': entry.get('remainder', 0),
-                    '合計数量': (entry.get('unit', 0) * entry.get('boxes', 0)) + entry.get('remainder', 0)
-                })
-            
-            df = pd.DataFrame(df_data)
+            # 編集可能なデータフレームの準備（列ごとにまとめて作成）
+            editor_columns = {
+                'store': '店舗名',
+                'item': '品目',
+                'spec': '規格',
+                'unit': '入数(unit)',
+                'boxes': '箱数(boxes)',
+                'remainder': '端数(remainder)'
+            }
+            df = pd.DataFrame(st.session_state.validated_data, columns=list(editor_columns)).rename(columns=editor_columns)
+            df['合計数量'] = df['入数(unit)'] * df['箱数(boxes)'] + df['端数(remainder)']
             
             # データエディタ
             edited_df = st.data_editor(
@@ -645,8 +1147,11 @@ with tab1:
             edited_df_for_compare = edited_df.drop(columns=['合計数量'])
             
             if not df_for_compare.equals(edited_df_for_compare):
+                # 数量の列はまとめて整数化（追加した行の空欄は0）
+                quantities = edited_df[['入数(unit)', '箱数(boxes)', '端数(remainder)']].apply(
+                    pd.to_numeric, errors='coerce').fillna(0).astype(int).values.tolist()
                 updated_data = []
-                for _, row in edited_df.iterrows():
+                for (_, row), (unit, boxes, remainder) in zip(edited_df.iterrows(), quantities):
                     # 品目名の正規化
                     normalized_item = normalize_item_name(row['品目'])
                     # 店舗名の検証
@@ -666,9 +1171,9 @@ with tab1:
                         'store': validated_store,
                         'item': normalized_item,
                         'spec': spec_value,
-                        'unit': int(row['入数(unit)']),
-                        'boxes': int(row['箱数(boxes)']),
-                        'remainder': int(row['端数(remainder)'])
+                        'unit': unit,
+                        'boxes': boxes,
+                        'remainder': remainder
                     })
                 
                 st.session_state.validated_data = updated_data
@@ -684,66 +1189,20 @@ with tab1:
                         final_data = validate_and_fix_order_data(st.session_state.validated_data)
                         
                         # PDF作成
-                        pdf_bytes = create_b5_pdf(final_data)
+                        pdf_bytes, summary_packs = create_b5_pdf_cached(final_data, datetime.now().date())
                         st.success("✅ 伝票が完成しました！")
 
-                        # LINE用集計の表示
+                        # LINE用集計の表示（集計はPDF作成時に済んでいる）
                         st.subheader("📋 LINE用集計（コピー用）")
-                        summary_packs = defaultdict(int)
-                        for entry in final_data:
-                            total = (safe_int(entry.get('unit',0)) * safe_int(entry.get('boxes',0))) + safe_int(entry.get('remainder',0))
-                            # キーをitemとspecの組み合わせにする（胡瓜の3本Pとバラを別物として扱う）
-                            item = entry.get('item', '不明')
-                            spec = entry.get('spec', '').strip()
-                            key = (item, spec)  # タプルをキーとして使用
-                            summary_packs[key] += total
-                        
-                        # 単位判定関数
-                        def get_unit_label(item, spec):
-                            """品目名と規格から単位を判定"""
-                            spec_lower = spec.lower() if spec else ""
-                            item_lower = item.lower() if item else ""
-                            
-                            # 胡瓜の判定
-                            if "胡瓜" in item or "きゅうり" in item_lower:
-                                if "バラ" in spec or "ばら" in spec_lower:
-                                    return "本"
-                                elif "3本" in spec or "3本p" in spec_lower or "3本パック" in spec_lower:
-                                    return "パック"
-                                else:
-                                    # デフォルトはパック（3本Pと判断）
-                                    return "パック"
-                            
-                            # 春菊・青梗菜
-                            if "春菊" in item or "青梗菜" in item or "チンゲン菜" in item:
-                                return "袋"
-                            
-                            # 長ネギ
-                            if "長ネギ" in item or "長ねぎ" in item_lower or "ネギ" in item:
-                                return "パック"
-                            
-                            # デフォルト
-                            return "パック"
-                        
-                        line_text = f"【{datetime.now().strftime('%m/%d')} 出荷・作成総数】\n"
-                        # キーをソートして表示（品目名→規格の順）
-                        sorted_items = sorted(summary_packs.items(), key=lambda x: (x[0][0], x[0][1]))
-                        for (item, spec), total in sorted_items:
-                            unit_label = get_unit_label(item, spec)
-                            # 表示形式: 品目名(規格)：数量単位
-                            if spec:
-                                display_name = f"{item}({spec})"
-                            else:
-                                display_name = item
-                            line_text += f"・{display_name}：{total}{unit_label}\n"
                         
+                        line_text = build_line_summary(summary_packs)
                         st.code(line_text, language="text")
                         st.write("↑ タップしてコピーし、LINEに貼り付けてください。")
 
                         # ダウンロードボタン
                         st.download_button(
                             label="📥 PDFをダウンロード (一覧表付き)",
-                            data=bytes(pdf_bytes),
+                            data=pdf_bytes,
                             file_name=f"label_{datetime.now().strftime('%m%d%H%M')}.pdf",
                             mime="application/pdf")
                     except Exception as e:
@@ -879,23 +1338,9 @@ with tab2:
                             days_back=days_back
                         )
                     
-                    if results:
-                        st.success(f"✅ {len(results)}件のメールから画像を取得しました")
-                        
-                        for idx, result in enumerate(results):
-                            with st.expander(f"📎 {result['filename']} - {result['subject']} ({result['date']})"):
-                                st.image(result['image'], caption=result['filename'], use_container_width=True)
-                                
-                                if st.button(f"🔍 この画像を解析", key=f"parse_{idx}"):
-                                    with st.spinner('解析中...'):
-                                        order_data = get_order_data(result['image'])
-                                        if order_data:
-                                            validated_data = validate_and_fix_order_data(order_data)
-                                            st.session_state.order_data = order_data
-                                            st.session_state.validated_data = validated_data
-                                            st.success(f"✅ {len(validated_data)}件のデータを読み取りました")
-                                            st.rerun()
-                    else:
+                    # 解析ボタンを押した後の再実行でも表示できるよう保持
+                    st.session_state.email_results = results
+                    if not results:
                         st.info("新しいメールは見つかりませんでした。")
                 
                 except Exception as e:
@@ -910,18 +1355,48 @@ with tab2:
             st.session_state.email_password = ""
             st.rerun()
     
+    # 取得したメール画像の表示・解析
+    email_results = st.session_state.email_results
+    if email_results:
+        st.success(f"✅ {len(email_results)}件のメールから画像を取得しました")
+        
+        order_data = None
+        if len(email_results) > 1 and st.button(
+            f"🔍 {len(email_results)}枚の画像をまとめて解析", type="primary", use_container_width=True, key="parse_all"
+        ):
+            # 全ての添付画像を1回の解析にまとめる（1枚ずつ解析するより往復回数が少ない）
+            with st.spinner('解析中...'):
+                order_data = analyze_images([result['data'] for result in email_results])
+        
+        for idx, result in enumerate(email_results):
+            with st.expander(f"📎 {result['filename']} - {result['subject']} ({result['date']})"):
+                st.image(make_preview_image(result['data']), caption=result['filename'], use_container_width=True)
+                
+                if st.button(f"🔍 この画像を解析", key=f"parse_{idx}"):
+                    with st.spinner('解析中...'):
+                        order_data = analyze_images([result['data']])
+        
+        if order_data:
+            validated_data = validate_and_fix_order_data(order_data)
+            st.session_state.order_data = order_data
+            st.session_state.validated_data = validated_data
+            st.success(f"✅ {len(validated_data)}件のデータを読み取りました")
+            st.rerun()
+    
     # 設定が保存されている場合の表示
     if saved_config.get("email_address"):
         st.success(f"💾 設定が保存されています: **{saved_config.get('email_address')}** ({saved_config.get('imap_server', '自動判定')}) - パスワードのみ入力してください")
 
 # ===== タブ3: 設定管理 =====
-with tab3:
+@st.fragment
+def render_settings_tab():
+    """設定管理タブを表示（入力中はこのタブだけを再実行し、追加・削除時は他タブの選択肢も更新するため全体を再実行）"""
     st.subheader("⚙️ 設定管理")
     st.write("店舗名と品目名を動的に管理できます。")
     
     # 店舗名管理
     st.subheader("🏪 店舗名管理")
-    stores = load_stores()
+    stores = get_known_stores()
     
     col1, col2 = st.columns([3, 1])
     with col1:
@@ -952,7 +1427,7 @@ with tab3:
     
     # 品目名管理
     st.subheader("🥬 品目名管理")
-    items = load_items()
+    items = get_item_normalization()
     
     col1, col2 = st.columns([3, 1])
     with col1:
@@ -985,3 +1460,6 @@ with tab3:
                     if remove_item(normalized):
                         st.success(f"✅ 「{normalized}」を削除しました")
                         st.rerun()
+
+with tab3:
+    render_settings_tab()
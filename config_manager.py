@@ -5,7 +5,7 @@
 import json
 import os
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 CONFIG_DIR = Path("config")
 STORES_FILE = CONFIG_DIR / "stores.json"
@@ -21,6 +21,25 @@ DEFAULT_ITEMS = {
     "春菊": ["春菊", "しゅんぎく", "シュンギク"]
 }
 
+# 設定の更新回数（保存のたびに増える。キャッシュの無効化に使用）
+_config_version = 0
+
+def _file_mtime(path: Path) -> float:
+    """ファイルの更新時刻（存在しない場合は0）"""
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0.0
+
+def get_config_version() -> Tuple[int, float, float]:
+    """設定の版を取得（保存回数＋ファイル更新時刻。手動編集も検知できる。キャッシュのキーに使用）"""
+    return (_config_version, _file_mtime(STORES_FILE), _file_mtime(ITEMS_FILE))
+
+def _bump_config_version():
+    """設定の更新回数を進める"""
+    global _config_version
+    _config_version += 1
+
 def ensure_config_dir():
     """設定ディレクトリが存在することを確認"""
     CONFIG_DIR.mkdir(exist_ok=True)
@@ -45,6 +64,7 @@ def save_stores(stores: List[str]):
     ensure_config_dir()
     with open(STORES_FILE, 'w', encoding='utf-8') as f:
         json.dump({'stores': stores}, f, ensure_ascii=False, indent=2)
+    _bump_config_version()
 
 def add_store(store_name: str) -> bool:
     """新しい店舗名を追加"""
@@ -83,6 +103,7 @@ def save_items(items: Dict[str, List[str]]):
     ensure_config_dir()
     with open(ITEMS_FILE, 'w', encoding='utf-8') as f:
         json.dump(items, f, ensure_ascii=False, indent=2)
+    _bump_config_version()
 
 def add_item_variant(normalized_name: str, variant: str):
     """品目のバリアント（表記ゆれ）を追加"""
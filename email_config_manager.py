@@ -4,6 +4,7 @@
 """
 import json
 import os
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, Dict
 
@@ -26,6 +27,7 @@ IMAP_SERVER_MAP = {
     "aol.com": "imap.aol.com"
 }
 
+@lru_cache(maxsize=64)
 def detect_imap_server(email_address: str) -> str:
     """メールアドレスからIMAPサーバーを自動判定"""
     if not email_address:
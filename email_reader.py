@@ -153,6 +153,7 @@ def check_email_for_orders(
                         'from': from_addr,
                         'date': date,
                         'image': img_info['image'],
+                        'data': img_info['data'],
                         'filename': img_info['filename']
                     })
             